@@ -1,13 +1,35 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request
 from flask_cors import CORS
 import os
+import asyncio
+import hashlib
+import orjson
+import threading
+import mmap
+import struct
+from contextlib import contextmanager
+import functools
+import math
+from collections import OrderedDict, defaultdict
+import queue
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from dotenv import load_dotenv
-import google.generativeai as genai
-from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
-from rouge import Rouge
-import nltk
-from datetime import datetime
+import httpx
 from bert_score import score
+from bert_score.utils import get_bert_embedding
+from cachetools import TTLCache
+import torch
+import numpy as np
+import regex
+from numpy.lib.stride_tricks import sliding_window_view
+from numba import njit
+
+# fcntl is Unix only; without it the shared embedding cache is unavailable
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Load environment variables
 load_dotenv()
@@ -16,75 +38,594 @@ load_dotenv()
 app = Flask(__name__)
 CORS(app)
 
-# Configure Google Generative AI
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-model = genai.GenerativeModel('gemini-2.0-flash-exp')
+# Gemini REST API over one pooled HTTP/2 client, so TLS and TCP setup is
+# paid once per connection instead of once per request
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp"
+gemini_client = httpx.Client(
+    http2=True,
+    timeout=float(os.getenv("GEMINI_TIMEOUT", 30.0)),
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+    headers={"x-goog-api-key": os.getenv("GEMINI_API_KEY", ""), "Content-Type": "application/json"}
+)
 
-# Initialize Rouge scorer
-rouge = Rouge()
+# Shared pool for the blocking Gemini and BERTScore calls of every request.
+# Each async request runs its own event loop, so asyncio.to_thread would
+# create a new default executor per request.
+executor = ThreadPoolExecutor(max_workers=int(os.getenv("EXECUTOR_WORKERS", 32)))
 
-# Initialize BERTScore model once at startup (faster)
-bert_scorer = None
-try:
-    from bert_score import BERTScorer
-    # Use a smaller, faster model
-    bert_scorer = BERTScorer(model_type="distilbert-base-uncased", num_layers=5)
-    print("BERTScore model loaded successfully!")
-except Exception as e:
-    print(f"Warning: Could not load BERTScore model: {e}")
-    bert_scorer = None
-
-# Download NLTK data if needed
-try:
-    nltk.data.find('tokenizers/punkt')
-except LookupError:
-    nltk.download('punkt')
+# Answers longer than this are rejected with 413: ROUGE-L is O(m*n) and
+# BERTScore truncates at the model's context length anyway
+MAX_ANSWER_CHARS = int(os.getenv("MAX_ANSWER_CHARS", 8192))
+
+# BERTScore is skipped for answers shorter than this many words
+MIN_BERT_TOKENS = 3
+
+# Scores for a student answer identical to the model answer
+EXACT_MATCH_SCORES = {"bleu": 1.0, "rouge-1": 1.0, "rouge-2": 1.0, "rouge-l": 1.0, "bert_score": 1.0}
+
+# BLEU settings: up to 4-grams, zero 2- to 4-gram matches are floored to 0.1
+# (as NLTK's SmoothingFunction().method1); no unigram match scores 0
+BLEU_MAX_ORDER = 4
+BLEU_SMOOTH_VALUE = 0.1
+
+# Tokenizer shared by BLEU and ROUGE: lowercase, with anything that is not a
+# letter, digit or whitespace treated as a word boundary
+NON_WORD_PATTERN = regex.compile(r"[^\p{L}\p{N}\s]+")
+
+# Multiplier for hashing an n-gram of token ids into a single uint64 key
+NGRAM_HASH_BASE = np.uint64(0x9E3779B97F4A7C15)
+
+# Cache feedback and BERTScore results for repeated (student, model) answer pairs.
+# Set REDIS_URL to share the cache between gunicorn workers.
+CACHE_TTL = int(os.getenv("CACHE_TTL", 3600))
+result_cache = TTLCache(maxsize=int(os.getenv("CACHE_SIZE", 10_000)), ttl=CACHE_TTL)
+result_cache_lock = threading.Lock()
+redis_client = None
+if os.getenv("REDIS_URL"):
+    try:
+        import redis
+        redis_client = redis.Redis.from_url(os.getenv("REDIS_URL"))
+    except Exception as e:
+        print(f"Warning: Could not connect to Redis, using in-process cache: {e}")
+        redis_client = None
+
+def greedy_match_f1(candidate, reference):
+    """BERTScore F1 from (normalized embeddings, idf weights) of both texts"""
+    cand_emb, cand_idf = candidate
+    ref_emb, ref_idf = reference
+    similarity = cand_emb @ ref_emb.T
+    precision = (similarity.max(dim=1).values * cand_idf).sum() / cand_idf.sum()
+    recall = (similarity.max(dim=0).values * ref_idf).sum() / ref_idf.sum()
+    f1 = float(2 * precision * recall / (precision + recall))
+    # A text with no weighted tokens gives 0/0; BERTScorer reports 0 there too
+    return 0.0 if math.isnan(f1) else f1
+
+class SharedEmbeddingCache:
+    """Model answer embeddings in a memory-mapped file shared by all worker processes
+
+    The file holds a header followed by a ring of fixed-size slots. Each slot
+    stores a 16-byte key, the token count, and the fp16 embeddings and idf
+    weights padded to max_tokens. Writers take an exclusive flock, readers a
+    shared one; each process keeps its own key -> slot index of the file.
+    The layout is part of the file name, so processes configured differently
+    use separate files instead of resizing one another's mapping.
+    """
+
+    HEADER = struct.Struct("<IIIQ40x")  # slots, max_tokens, dim, slots written
+    SLOT_HEADER = struct.Struct("<16sI12x")  # key, token count
+
+    def __init__(self, path, namespace, slots, max_tokens, dim):
+        self.path = f"{path}.{slots}x{max_tokens}x{dim}"
+        self.namespace = namespace
+        self.slots = slots
+        self.max_tokens = max_tokens
+        self.dim = dim
+        self.slot_size = self.SLOT_HEADER.size + max_tokens * (dim + 1) * 2
+        self.size = self.HEADER.size + slots * self.slot_size
+        self.pid = None
+
+    def _open(self):
+        # Opened lazily so each forked worker gets its own descriptor and mapping
+        if self.pid == os.getpid():
+            return
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self._locked(fcntl.LOCK_EX):
+            # Only ever grow the file: shrinking it would SIGBUS processes mapping it
+            if os.fstat(self.fd).st_size < self.size:
+                os.ftruncate(self.fd, self.size)
+            layout = (self.slots, self.max_tokens, self.dim)
+            if self.HEADER.unpack(os.pread(self.fd, self.HEADER.size, 0))[:3] != layout:
+                # New (zero-filled) file
+                os.pwrite(self.fd, self.HEADER.pack(*layout, 0), 0)
+        self.map = mmap.mmap(self.fd, self.size)
+        self.index = {}
+        self.slot_keys = {}
+        self.seen = 0
+        self.pid = os.getpid()
+
+    @contextmanager
+    def _locked(self, operation):
+        fcntl.flock(self.fd, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _key(self, text):
+        return hashlib.blake2b(f"{self.namespace}\x00{text}".encode(), digest_size=16).digest()
+
+    def _offset(self, slot):
+        return self.HEADER.size + slot * self.slot_size
+
+    def _written(self):
+        return self.HEADER.unpack_from(self.map, 0)[3]
+
+    def _index_slot(self, slot, key):
+        old_key = self.slot_keys.get(slot)
+        # The old key may already point at a newer copy in another slot
+        if old_key is not None and self.index.get(old_key) == slot:
+            del self.index[old_key]
+        self.slot_keys[slot] = key
+        self.index[key] = slot
+
+    def _refresh(self):
+        """Index slots written by other workers since the last refresh"""
+        written = self._written()
+        for n in range(max(self.seen, written - self.slots), written):
+            slot = n % self.slots
+            self._index_slot(slot, self.SLOT_HEADER.unpack_from(self.map, self._offset(slot))[0])
+        self.seen = written
+
+    def get(self, text):
+        """Return (embeddings, idf) as fp16 CPU tensors, or None on a miss"""
+        self._open()
+        key = self._key(text)
+        with self._locked(fcntl.LOCK_SH):
+            if key not in self.index:
+                self._refresh()
+            slot = self.index.get(key)
+            if slot is None:
+                return None
+            offset = self._offset(slot)
+            stored_key, length = self.SLOT_HEADER.unpack_from(self.map, offset)
+            if stored_key != key:
+                return None
+            offset += self.SLOT_HEADER.size
+            emb = np.frombuffer(self.map, np.float16, length * self.dim, offset)
+            idf = np.frombuffer(self.map, np.float16, length, offset + self.max_tokens * self.dim * 2)
+            return torch.from_numpy(emb.reshape(length, self.dim).copy()), torch.from_numpy(idf.copy())
+
+    def put(self, text, emb, idf):
+        """Store embeddings and idf weights; return False if the text is longer than max_tokens"""
+        length = emb.shape[0]
+        if length > self.max_tokens:
+            return False
+        self._open()
+        key = self._key(text)
+        emb = emb.to("cpu", torch.float16).numpy()
+        idf = idf.to("cpu", torch.float16).numpy()
+        with self._locked(fcntl.LOCK_EX):
+            # Another worker may have stored the same text while this one was encoding it
+            self._refresh()
+            slot = self.index.get(key)
+            if slot is not None and self.SLOT_HEADER.unpack_from(self.map, self._offset(slot))[0] == key:
+                return True
+            written = self._written()
+            slot = written % self.slots
+            offset = self._offset(slot)
+            self.SLOT_HEADER.pack_into(self.map, offset, key, length)
+            offset += self.SLOT_HEADER.size
+            np.frombuffer(self.map, np.float16, length * self.dim, offset)[:] = emb.ravel()
+            np.frombuffer(self.map, np.float16, length, offset + self.max_tokens * self.dim * 2)[:] = idf
+            self.HEADER.pack_into(self.map, 0, self.slots, self.max_tokens, self.dim, written + 1)
+            self._refresh()
+        return True
+
+class BertBatcher:
+    """Coalesce concurrent BERTScore requests into one batched forward pass"""
+
+    def __init__(self, scorer, namespace, max_batch_size, max_wait_ms, reference_cache_size, shared_cache=None):
+        self.scorer = scorer
+        # Model, layers, device and precision; scores from different setups differ
+        self.namespace = namespace
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker_pid = None
+        # Model answer embeddings, only touched from the batching thread
+        self.reference_embeddings = OrderedDict()
+        self.reference_cache_size = reference_cache_size
+        # Optional cross-process cache behind the in-process one
+        self.shared_cache = shared_cache
+        self.embedding_dtype = torch.float16 if str(scorer.device).startswith("cuda") else torch.float32
+        # Uniform token weights as BERTScorer uses without idf; [CLS]/[SEP] are ignored
+        self.idf_dict = defaultdict(lambda: 1.0)
+        self.idf_dict[scorer._tokenizer.sep_token_id] = 0
+        self.idf_dict[scorer._tokenizer.cls_token_id] = 0
+
+    def submit(self, candidate, reference):
+        """Queue a pair for scoring and return a Future resolving to its F1"""
+        self._ensure_worker()
+        future = Future()
+        self.queue.put((candidate, reference, future))
+        return future
+
+    def _ensure_worker(self):
+        # Threads do not survive fork, so each gunicorn worker starts its own
+        # (with a fresh queue, whose waiters may belong to the parent's thread)
+        if self.worker_pid == os.getpid():
+            return
+        with self.lock:
+            if self.worker_pid != os.getpid():
+                self.queue = queue.Queue()
+                threading.Thread(target=self._run, daemon=True).start()
+                self.worker_pid = os.getpid()
+
+    def _next_batch(self):
+        """Block for one request, then collect more until the batch is full or the window closes"""
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _encode(self, texts):
+        """Return (normalized embeddings, idf weights) per text, trimmed to its tokens"""
+        embeddings, masks, idf = get_bert_embedding(
+            texts, self.scorer._model, self.scorer._tokenizer, self.idf_dict, device=self.scorer.device
+        )
+        encoded = []
+        for i in range(len(texts)):
+            length = int(masks[i].sum())
+            emb = embeddings[i, :length]
+            encoded.append((emb / emb.norm(dim=-1, keepdim=True), idf[i, :length]))
+        return encoded
+
+    def _load_shared(self, references):
+        """Pull model answers from the shared cache; return those still missing"""
+        missing = []
+        for reference in dict.fromkeys(references):
+            if reference in self.reference_embeddings:
+                continue
+            shared = None
+            if self.shared_cache is not None:
+                try:
+                    shared = self.shared_cache.get(reference)
+                except Exception as e:
+                    print(f"Shared embedding cache error: {e}")
+            if shared is None:
+                missing.append(reference)
+            else:
+                emb, idf = shared
+                self.reference_embeddings[reference] = (
+                    emb.to(self.scorer.device, self.embedding_dtype),
+                    idf.to(self.scorer.device, torch.float32)
+                )
+        return missing
+
+    def _score(self, candidates, references):
+        """Score a batch, encoding only candidates and model answers not seen before"""
+        missing = self._load_shared(references)
+        texts = list(dict.fromkeys(candidates + missing))
+        with torch.inference_mode():
+            encoded = dict(zip(texts, self._encode(texts)))
+            new_references = {reference: encoded[reference] for reference in missing}
+            if self.shared_cache is not None:
+                try:
+                    for reference in missing:
+                        if self.shared_cache.put(reference, *encoded[reference]):
+                            # Score with the fp16 copy other workers will read, so every
+                            # worker gives the same result for the same answer pair
+                            emb, idf = encoded[reference]
+                            new_references[reference] = (
+                                emb.to(torch.float16).to(self.embedding_dtype),
+                                idf.to(torch.float16).to(torch.float32)
+                            )
+                except Exception as e:
+                    print(f"Shared embedding cache error: {e}")
+            scores = []
+            for candidate, reference in zip(candidates, references):
+                if reference in new_references:
+                    self.reference_embeddings[reference] = new_references[reference]
+                self.reference_embeddings.move_to_end(reference)
+                scores.append(greedy_match_f1(encoded[candidate], self.reference_embeddings[reference]))
+        while len(self.reference_embeddings) > self.reference_cache_size:
+            self.reference_embeddings.popitem(last=False)
+        return scores
+
+    def _run(self):
+        while True:
+            candidates, references, futures = zip(*self._next_batch())
+            try:
+                scores = self._score(list(candidates), list(references))
+                for future, f1 in zip(futures, scores):
+                    future.set_result(f1)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+
+# Nothing in this service needs autograd. Grad mode is per thread, so the
+# batching thread additionally scores under torch.inference_mode()
+torch.set_grad_enabled(False)
+
+@functools.lru_cache(maxsize=None)
+def load_bert_batcher():
+    """Load the BERTScore model and wrap it in a batcher, or return None if it fails"""
+    try:
+        from bert_score import BERTScorer
+        # Use a smaller, faster model
+        model_type, num_layers = "distilbert-base-uncased", 5
+        bert_scorer = BERTScorer(
+            model_type=model_type,
+            num_layers=num_layers,
+            device="cuda" if torch.cuda.is_available() else "cpu"
+        )
+        precision = "fp32"
+        if str(bert_scorer.device).startswith("cuda"):
+            # FP16 halves memory bandwidth and runs on tensor cores
+            bert_scorer._model = bert_scorer._model.half()
+            precision = "fp16"
+        elif os.getenv("BERT_QUANTIZE", "1") == "1":
+            # Dynamic INT8 quantization of the linear layers roughly doubles CPU throughput
+            bert_scorer._model = torch.quantization.quantize_dynamic(
+                bert_scorer._model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+            precision = "int8"
+        namespace = f"{model_type}:{num_layers}:{bert_scorer.device}:{precision}"
+        print("BERTScore model loaded successfully!")
+    except Exception as e:
+        print(f"Warning: Could not load BERTScore model: {e}")
+        return None
+    
+    # Share model answer embeddings between workers through a memory-mapped file
+    shared_cache = None
+    reference_cache_size = int(os.getenv("BERT_REFERENCE_CACHE_SIZE", 1000))
+    if os.getenv("BERT_EMBEDDING_CACHE_PATH") and fcntl is None:
+        print("Warning: BERT_EMBEDDING_CACHE_PATH needs fcntl, which this platform lacks; not sharing embeddings")
+    elif os.getenv("BERT_EMBEDDING_CACHE_PATH"):
+        shared_cache = SharedEmbeddingCache(
+            os.getenv("BERT_EMBEDDING_CACHE_PATH"),
+            # Embeddings from a differently placed or quantized model are not interchangeable
+            namespace=namespace,
+            slots=int(os.getenv("BERT_EMBEDDING_CACHE_SLOTS", 1024)),
+            max_tokens=int(os.getenv("BERT_EMBEDDING_CACHE_MAX_TOKENS", 256)),
+            dim=bert_scorer._model.config.hidden_size
+        )
+        # The shared file already holds every model answer once; keep only the hottest in process memory
+        reference_cache_size = int(os.getenv("BERT_REFERENCE_CACHE_SIZE", 32))
+    
+    # Requests arriving within BERT_BATCH_WAIT_MS of each other share one forward pass
+    return BertBatcher(
+        bert_scorer,
+        namespace,
+        max_batch_size=int(os.getenv("BERT_BATCH_SIZE", 16)),
+        max_wait_ms=float(os.getenv("BERT_BATCH_WAIT_MS", 20)),
+        reference_cache_size=reference_cache_size,
+        shared_cache=shared_cache
+    )
+
+bert_load_lock = threading.Lock()
+
+def get_bert_batcher():
+    """Return the process-wide BERTScore batcher, loading the model on first use"""
+    with bert_load_lock:
+        return load_bert_batcher()
+
+# Answer pairs scored both ways at warm-up to confirm the batched scorer agrees with bert_score
+BERT_CHECK_PAIRS = [
+    ("Plants make food from sunlight.", "Photosynthesis converts light energy into chemical energy in plants."),
+    ("The heart pumps blood around the body", "The heart pumps blood through the body via arteries and veins"),
+]
+
+def check_bert_batcher(bert_batcher):
+    """Warn if the batched scorer's F1 differs from BERTScorer.score() on BERT_CHECK_PAIRS"""
+    candidates, references = map(list, zip(*BERT_CHECK_PAIRS))
+    with torch.inference_mode():
+        expected = bert_batcher.scorer.score(candidates, references)[2].tolist()
+        encoded = bert_batcher._encode(candidates + references)
+    actual = [greedy_match_f1(c, r) for c, r in zip(encoded[:len(candidates)], encoded[len(candidates):])]
+    # FP16 on CUDA reorders rounding; anything beyond that is a real divergence
+    tolerance = 1e-2 if bert_batcher.embedding_dtype == torch.float16 else 1e-4
+    for pair, a, e in zip(BERT_CHECK_PAIRS, actual, expected):
+        if not math.isclose(a, e, abs_tol=tolerance):
+            print(f"Warning: BERTScore mismatch on {pair}: batched {a:.6f}, bert_score {e:.6f}")
+
+def warm_up_bert():
+    """Load the model and score a dummy pair so the first request pays no setup cost"""
+    bert_batcher = get_bert_batcher()
+    if bert_batcher is not None:
+        try:
+            bert_batcher.submit("warm up", "warm up").result()
+            check_bert_batcher(bert_batcher)
+        except Exception as e:
+            print(f"BERTScore warm-up failed: {e}")
+
+def start_bert_warmup():
+    """Warm up BERTScore in the background unless BERT_WARMUP=0 (load on first use)"""
+    if os.getenv("BERT_WARMUP", "1") == "1":
+        threading.Thread(target=warm_up_bert, daemon=True).start()
+
+# Loading the model no longer blocks import. gunicorn.conf.py turns this off
+# and warms up from its server hooks, so the master never forks with a live thread.
+if os.getenv("BERT_WARMUP_ON_IMPORT", "1") == "1":
+    start_bert_warmup()
+
+def cache_key(kind, student_answer, model_answer):
+    """Build a cache key from the whitespace-normalized answer pair"""
+    student_answer = " ".join(student_answer.split())
+    model_answer = " ".join(model_answer.split())
+    digest = hashlib.blake2b(f"{student_answer}\x00{model_answer}".encode(), digest_size=16).digest()
+    return kind.encode() + b":" + digest
+
+def cache_get(key):
+    """Return a cached result, or None on a miss"""
+    if redis_client is not None:
+        try:
+            value = redis_client.get(key)
+            return None if value is None else orjson.loads(value)
+        except Exception as e:
+            print(f"Redis cache error: {e}")
+    with result_cache_lock:
+        return result_cache.get(key)
+
+def cache_set(key, value):
+    """Store a result in the cache"""
+    if redis_client is not None:
+        try:
+            redis_client.setex(key, CACHE_TTL, orjson.dumps(value))
+            return
+        except Exception as e:
+            print(f"Redis cache error: {e}")
+    with result_cache_lock:
+        result_cache[key] = value
+
+@functools.lru_cache(maxsize=65536)
+def word_id(word):
+    """Deterministic 64-bit id of a word, the same in every worker and across restarts"""
+    return int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "little")
+
+def tokenize(text):
+    """Split normalized text into words and map each to a hashed uint64 id"""
+    words = NON_WORD_PATTERN.sub(" ", text.lower()).split()
+    return np.fromiter(map(word_id, words), dtype=np.uint64, count=len(words))
+
+def ngram_counts(tokens):
+    """Count the 1- to BLEU_MAX_ORDER-grams of a token id array as (keys, counts) pairs"""
+    counts = []
+    for n in range(1, BLEU_MAX_ORDER + 1):
+        windows = sliding_window_view(tokens, n) if len(tokens) >= n else np.empty((0, n), np.uint64)
+        keys = windows[:, 0]
+        for k in range(1, n):
+            keys = keys * NGRAM_HASH_BASE + windows[:, k]
+        counts.append(np.unique(keys, return_counts=True))
+    return tuple(counts)
+
+def clipped_matches(candidate_ngrams, reference_ngrams):
+    """Number of candidate n-grams also in the reference, clipped to the reference count"""
+    cand_keys, cand_counts = candidate_ngrams
+    ref_keys, ref_counts = reference_ngrams
+    _, cand_idx, ref_idx = np.intersect1d(cand_keys, ref_keys, assume_unique=True, return_indices=True)
+    return int(np.minimum(cand_counts[cand_idx], ref_counts[ref_idx]).sum())
+
+def analyze_text(text):
+    """Token ids and n-gram counts of a text, counted once and shared by BLEU and ROUGE"""
+    tokens = tokenize(text)
+    return tokens, ngram_counts(tokens)
+
+@functools.lru_cache(maxsize=1024)
+def analyze_reference(reference):
+    """analyze_text() of a model answer, reused for every student graded against it"""
+    tokens, counts = analyze_text(reference)
+    tokens.flags.writeable = False
+    return tokens, counts
 
 def calculate_bleu(reference, candidate):
-    """Calculate BLEU score between reference and candidate texts"""
+    """Calculate BLEU score between analyzed reference and candidate texts"""
     try:
-        smoothing_function = SmoothingFunction().method1
-        ref_tokens = reference.split()
-        cand_tokens = candidate.split()
-        bleu_score = sentence_bleu([ref_tokens], cand_tokens, smoothing_function=smoothing_function)
-        return bleu_score
+        ref_tokens, ref_counts = reference
+        candidate_tokens, cand_counts = candidate
+        if len(candidate_tokens) == 0:
+            return 0.0
+        
+        # Orders the candidate is too short for are left out (effective order)
+        log_precision = 0.0
+        order = 0
+        for cand_ngrams, ref_ngrams in zip(cand_counts, ref_counts):
+            total = len(candidate_tokens) - order
+            if total <= 0:
+                break
+            correct = clipped_matches(cand_ngrams, ref_ngrams)
+            if correct == 0 and order == 0:
+                # No word in common: BLEU is 0, smoothing only applies to higher orders
+                return 0.0
+            log_precision += math.log((correct or BLEU_SMOOTH_VALUE) / total)
+            order += 1
+        
+        brevity_penalty = min(1.0, math.exp(1 - len(ref_tokens) / len(candidate_tokens)))
+        return brevity_penalty * math.exp(log_precision / order)
     except Exception as e:
         return 0.0
 
+@njit(cache=True, boundscheck=False)
+def lcs_length(a, b):
+    """Length of the longest common subsequence of two token id arrays"""
+    m, n = a.shape[0], b.shape[0]
+    prev = np.zeros(n + 1, np.int32)
+    cur = np.zeros(n + 1, np.int32)
+    for i in range(1, m + 1):
+        for j in range(1, n + 1):
+            if a[i - 1] == b[j - 1]:
+                cur[j] = prev[j - 1] + 1
+            else:
+                cur[j] = max(prev[j], cur[j - 1])
+        prev, cur = cur, prev
+    return prev[n]
+
+# Compile at import rather than on the first request; the model answer's ids are
+# read-only (cached), which numba treats as a separate signature
+_warmup_reference = np.zeros(1, np.uint64)
+_warmup_reference.flags.writeable = False
+lcs_length(np.zeros(1, np.uint64), _warmup_reference)
+
+def rouge_f1(overlap, candidate_total, reference_total):
+    """F1 of an overlap count against candidate (precision) and reference (recall) totals"""
+    precision = overlap / candidate_total if candidate_total else 0.0
+    recall = overlap / reference_total if reference_total else 0.0
+    return 2.0 * ((precision * recall) / (precision + recall + 1e-8))
+
 def calculate_rouge(reference, candidate):
-    """Calculate ROUGE score between reference and candidate texts"""
+    """Calculate ROUGE score between analyzed reference and candidate texts"""
     try:
-        scores = rouge.get_scores(candidate, reference)[0]
-        return {
-            'rouge-1': scores['rouge-1']['f'],
-            'rouge-2': scores['rouge-2']['f'],
-            'rouge-l': scores['rouge-l']['f']
-        }
+        ref_tokens, ref_counts = reference
+        candidate_tokens, cand_counts = candidate
+        scores = {}
+        # Unigram and bigram counts are the same ones BLEU used
+        for n, cand_ngrams, ref_ngrams in zip((1, 2), cand_counts, ref_counts):
+            overlap = clipped_matches(cand_ngrams, ref_ngrams)
+            scores[f'rouge-{n}'] = rouge_f1(overlap, int(cand_ngrams[1].sum()), int(ref_ngrams[1].sum()))
+        overlap = int(lcs_length(candidate_tokens, ref_tokens))
+        scores['rouge-l'] = rouge_f1(overlap, len(candidate_tokens), len(ref_tokens))
+        return scores
     except Exception as e:
         return {'rouge-1': 0.0, 'rouge-2': 0.0, 'rouge-l': 0.0}
 
 def calculate_bert_score(reference, candidate):
     """Calculate BERTScore between reference and candidate texts - Fast version"""
     try:
-        if bert_scorer is None:
+        bert_batcher = get_bert_batcher()
+        if bert_batcher is None:
             return 0.0
         
-        # Use pre-loaded scorer (much faster)
-        P, R, F1 = bert_scorer.score([candidate], [reference])
-        return float(F1[0])
+        # Shared Redis caches may serve workers running the model on different setups
+        key = cache_key(f"bert:{bert_batcher.namespace}", candidate, reference)
+        cached = cache_get(key)
+        if cached is not None:
+            return cached
+        
+        # Batched with other in-flight requests on the pre-loaded scorer
+        bert_score = bert_batcher.submit(candidate, reference).result()
+        cache_set(key, bert_score)
+        return bert_score
     except Exception as e:
         print(f"BERTScore error: {e}")
         return 0.0
 
-def generate_feedback(student_answer, model_answer, bleu_score, rouge_scores, bert_score):
-    """Generate feedback using Google Gemini"""
-    try:
-        prompt = f"""
+# Feedback prompt templates, selected with the "style" field of /grade
+DEFAULT_STYLE = "brief"
+PROMPTS = {
+    "brief": """
         You are an experienced teacher. Give brief and clear feedback for the student's answer in plain English.
         
         Student's Answer: {student_answer}
         Model Answer: {model_answer}
-        Evaluation Scores: BLEU={bleu_score:.3f}, ROUGE-1={rouge_scores['rouge-1']:.3f}, BERTScore={bert_score:.3f}
+        Evaluation Scores: BLEU={bleu_score:.3f}, ROUGE-1={rouge_1:.3f}
         
         Write your evaluation naturally and simply, without any special formatting or symbols:
         
@@ -94,17 +635,164 @@ def generate_feedback(student_answer, model_answer, bleu_score, rouge_scores, be
         Fourth, give one helpful tip for improvement.
         
         Do not use any symbols or formatting marks, just plain clear text.
-        """
+        """,
+    "detailed": """
+        You are an experienced teacher. Give detailed and constructive feedback for the student's answer in plain English.
+        
+        Student's Answer: {student_answer}
+        Model Answer: {model_answer}
+        Evaluation Scores: BLEU={bleu_score:.3f}, ROUGE-1={rouge_1:.3f}
         
-        response = model.generate_content(prompt)
-        return response.text
+        Write your evaluation naturally, without any special formatting or symbols:
+        
+        First, explain each point the student got right and why it is correct.
+        Second, explain each important point they missed or got wrong, and what the correct idea is.
+        Third, give a grade from A to F and justify it against the model answer.
+        Fourth, give two or three concrete tips for improvement.
+        
+        Do not use any symbols or formatting marks, just plain clear text.
+        """,
+    "plain": """
+        You are an experienced teacher. In two or three simple sentences, tell the student how their answer compares to the model answer.
+        
+        Student's Answer: {student_answer}
+        Model Answer: {model_answer}
+        Evaluation Scores: BLEU={bleu_score:.3f}, ROUGE-1={rouge_1:.3f}
+        
+        Do not use any symbols or formatting marks, just plain clear text.
+        """,
+}
+
+def build_feedback_prompt(style, student_answer, model_answer, bleu_score, rouge_scores):
+    """Fill in the feedback prompt template for a style"""
+    return PROMPTS[style].format_map({
+        "student_answer": student_answer,
+        "model_answer": model_answer,
+        "bleu_score": bleu_score,
+        "rouge_1": rouge_scores['rouge-1']
+    })
+
+def gemini_request_body(prompt):
+    """Encode a generateContent request for a single text prompt"""
+    return orjson.dumps({"contents": [{"parts": [{"text": prompt}]}]})
+
+def gemini_response_text(data, allow_empty=False):
+    """Extract the generated text from a generateContent response
+
+    Raises ValueError if the prompt was blocked, or if there is no text (e.g. a
+    safety stop) unless allow_empty is set for a stream chunk.
+    """
+    candidates = data.get("candidates")
+    if not candidates:
+        raise ValueError(f"Gemini returned no response (promptFeedback: {data.get('promptFeedback')})")
+    parts = candidates[0].get("content", {}).get("parts", [])
+    text = "".join(part.get("text", "") for part in parts)
+    if not text and not allow_empty:
+        raise ValueError(f"Gemini returned no text (finishReason: {candidates[0].get('finishReason')})")
+    return text
+
+def generate_feedback(style, student_answer, model_answer, bleu_score, rouge_scores):
+    """Generate feedback using Google Gemini"""
+    try:
+        # Scores are derived from the answers, so style and answer pair identify the prompt
+        key = cache_key(f"feedback:{style}", student_answer, model_answer)
+        cached = cache_get(key)
+        if cached is not None:
+            return cached
+        
+        prompt = build_feedback_prompt(style, student_answer, model_answer, bleu_score, rouge_scores)
+        response = gemini_client.post(f"{GEMINI_URL}:generateContent", content=gemini_request_body(prompt))
+        response.raise_for_status()
+        feedback = gemini_response_text(orjson.loads(response.content))
+        cache_set(key, feedback)
+        return feedback
     except Exception as e:
         return f"Error generating feedback: {str(e)}"
 
+def stream_feedback(style, student_answer, model_answer, bleu_score, rouge_scores):
+    """Yield feedback text from Google Gemini chunk by chunk as it is generated"""
+    try:
+        key = cache_key(f"feedback:{style}", student_answer, model_answer)
+        cached = cache_get(key)
+        if cached is not None:
+            yield cached
+            return
+        
+        prompt = build_feedback_prompt(style, student_answer, model_answer, bleu_score, rouge_scores)
+        chunks = []
+        finish_reason = None
+        with gemini_client.stream(
+            "POST",
+            f"{GEMINI_URL}:streamGenerateContent",
+            params={"alt": "sse"},
+            content=gemini_request_body(prompt)
+        ) as response:
+            response.raise_for_status()
+            # Server-sent events, one "data: {...}" line per chunk
+            for line in response.iter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = orjson.loads(line[5:])
+                chunk = gemini_response_text(data, allow_empty=True)
+                finish_reason = data["candidates"][0].get("finishReason", finish_reason)
+                if chunk:
+                    chunks.append(chunk)
+                    yield chunk
+        if not chunks:
+            raise ValueError(f"Gemini returned no text (finishReason: {finish_reason})")
+        cache_set(key, "".join(chunks))
+    except Exception as e:
+        yield f"Error generating feedback: {str(e)}"
+
+def build_scores(bleu_score, rouge_scores, bert_score):
+    """Round the scores for the response"""
+    return {
+        "bleu": round(bleu_score, 4),
+        "rouge-1": round(rouge_scores['rouge-1'], 4),
+        "rouge-2": round(rouge_scores['rouge-2'], 4),
+        "rouge-l": round(rouge_scores['rouge-l'], 4),
+        "bert_score": round(bert_score, 4)
+    }
+
+# (second, formatted timestamp), replaced as a whole so threads never see a torn pair
+timestamp_cache = (0, "")
+
+def iso_now():
+    """Current UTC time as an ISO 8601 string, formatted at most once per second"""
+    global timestamp_cache
+    now = int(time.time())
+    second, formatted = timestamp_cache
+    if now != second:
+        formatted = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now))
+        timestamp_cache = (now, formatted)
+    return formatted
+
+def json_response(payload, status=200):
+    """Serialize a response body with orjson (faster than jsonify)"""
+    return app.response_class(
+        orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY),
+        status=status,
+        mimetype="application/json"
+    )
+
+def ndjson_response(student_answer, model_answer, scores, feedback_chunks):
+    """Stream the scores as one JSON line, then one line per feedback chunk"""
+    def generate():
+        yield orjson.dumps({
+            "student_answer": student_answer,
+            "model_answer": model_answer,
+            "scores": scores,
+            "timestamp": iso_now()
+        }, option=orjson.OPT_APPEND_NEWLINE)
+        for chunk in feedback_chunks:
+            yield orjson.dumps({"feedback": chunk}, option=orjson.OPT_APPEND_NEWLINE)
+    
+    return Response(generate(), mimetype="application/x-ndjson")
+
 @app.route('/', methods=['GET'])
 def home():
     """Home endpoint"""
-    return jsonify({
+    return json_response({
         "message": "Grading System API",
         "version": "1.0.0",
         "endpoints": {
@@ -116,61 +804,109 @@ def home():
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({"status": "healthy", "message": "API is running"})
+    return json_response({"status": "healthy", "message": "API is running"})
 
 @app.route('/grade', methods=['POST'])
-def grade_answer():
+async def grade_answer():
     """Grade student answer against model answer"""
     try:
         # Get JSON data from request
-        data = request.get_json()
+        body = request.get_data()
+        if not body:
+            return json_response({"error": "No JSON data provided"}, 400)
+        try:
+            data = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            return json_response({"error": "Invalid JSON data"}, 400)
         
         # Validate input
         if not data:
-            return jsonify({"error": "No JSON data provided"}), 400
+            return json_response({"error": "No JSON data provided"}, 400)
         
         student_answer = data.get('student_answer', '').strip()
         model_answer = data.get('model_answer', '').strip()
         use_bert = data.get('use_bert', True)  # Option to disable BERTScore for speed
+        stream = data.get('stream', False)  # Option to stream feedback as NDJSON
+        style = data.get('style', DEFAULT_STYLE)  # Feedback prompt style
         
         if not student_answer or not model_answer:
-            return jsonify({"error": "Both student_answer and model_answer are required"}), 400
+            return json_response({"error": "Both student_answer and model_answer are required"}, 400)
+        
+        if not isinstance(style, str) or style not in PROMPTS:
+            return json_response({"error": f"style must be one of: {', '.join(PROMPTS)}"}, 400)
+        
+        if len(student_answer) > MAX_ANSWER_CHARS or len(model_answer) > MAX_ANSWER_CHARS:
+            return json_response({"error": f"Answers must be at most {MAX_ANSWER_CHARS} characters"}, 413)
+        
+        # Identical answers need no scoring or feedback
+        if student_answer == model_answer:
+            if stream:
+                return ndjson_response(student_answer, model_answer, EXACT_MATCH_SCORES, ["Exact match."])
+            return json_response({
+                "student_answer": student_answer,
+                "model_answer": model_answer,
+                "scores": EXACT_MATCH_SCORES,
+                "feedback": "Exact match.",
+                "timestamp": iso_now()
+            }, 200)
+        
+        # Calculate scores (BLEU and ROUGE are cheap, compute them inline)
+        # Tokenize and count n-grams once; the model answer is cached across students
+        reference = analyze_reference(model_answer)
+        student = analyze_text(student_answer)
+        bleu_score = calculate_bleu(reference, student)
+        
+        # BERTScore is not meaningful for one or two word answers
+        if len(student[0]) < MIN_BERT_TOKENS or len(reference[0]) < MIN_BERT_TOKENS:
+            use_bert = False
+        rouge_scores = calculate_rouge(reference, student)
+        
+        loop = asyncio.get_running_loop()
         
-        # Calculate scores
-        bleu_score = calculate_bleu(model_answer, student_answer)
-        rouge_scores = calculate_rouge(model_answer, student_answer)
+        if stream:
+            bert_score = 0.0
+            if use_bert:
+                bert_score = await loop.run_in_executor(executor, calculate_bert_score, model_answer, student_answer)
+            # Scores first, then feedback chunks as Gemini produces them
+            return ndjson_response(
+                student_answer,
+                model_answer,
+                build_scores(bleu_score, rouge_scores, bert_score),
+                stream_feedback(style, student_answer, model_answer, bleu_score, rouge_scores)
+            )
         
-        # Only calculate BERTScore if requested and model is available
-        bert_score = 0.0
-        if use_bert and bert_scorer is not None:
-            bert_score = calculate_bert_score(model_answer, student_answer)
+        # Generate feedback while BERTScore runs, both block outside the GIL
+        feedback_task = loop.run_in_executor(
+            executor, generate_feedback, style, student_answer, model_answer, bleu_score, rouge_scores
+        )
         
-        # Generate feedback
-        feedback = generate_feedback(student_answer, model_answer, bleu_score, rouge_scores, bert_score)
+        # Only calculate BERTScore if requested (0.0 if the model is unavailable)
+        if use_bert:
+            bert_score, feedback = await asyncio.gather(
+                loop.run_in_executor(executor, calculate_bert_score, model_answer, student_answer),
+                feedback_task
+            )
+        else:
+            bert_score = 0.0
+            feedback = await feedback_task
         
         # Prepare response
         response = {
             "student_answer": student_answer,
             "model_answer": model_answer,
-            "scores": {
-                "bleu": round(bleu_score, 4),
-                "rouge-1": round(rouge_scores['rouge-1'], 4),
-                "rouge-2": round(rouge_scores['rouge-2'], 4),
-                "rouge-l": round(rouge_scores['rouge-l'], 4),
-                "bert_score": round(bert_score, 4)
-            },
+            "scores": build_scores(bleu_score, rouge_scores, bert_score),
             "feedback": feedback,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": iso_now()
         }
         
-        return jsonify(response), 200
+        return json_response(response, 200)
         
     except Exception as e:
-        return jsonify({"error": f"Internal server error: {str(e)}"}), 500
+        return json_response({"error": f"Internal server error: {str(e)}"}, 500)
 
-if __name__ == '__main__':
-    # Check if required environment variables are set
-    if not os.getenv("GEMINI_API_KEY"):
-        print("Warning: GEMINI_API_KEY not found in environment variables")
+# Check if required environment variables are set
+if not os.getenv("GEMINI_API_KEY"):
+    print("Warning: GEMINI_API_KEY not found in environment variables")
 
-    app.run(debug=True, host='0.0.0.0', port=5000)
+# Served by gunicorn, see gunicorn.conf.py:
+#   gunicorn -c gunicorn.conf.py API:app
@@ -0,0 +1,50 @@
+"""Gunicorn configuration for the Grading System API.
+
+Run with:
+    gunicorn -c gunicorn.conf.py API:app
+
+Each /grade request spends most of its time waiting on Gemini or inside
+torch kernels, both of which release the GIL, so threaded workers give
+near-linear throughput with the number of cores.
+"""
+import multiprocessing
+import os
+
+# Warm up BERTScore from the hooks below rather than in a thread at import,
+# so the master never forks while a background thread is running
+os.environ.setdefault("BERT_WARMUP_ON_IMPORT", "0")
+# Let torch.cuda.is_available() query NVML instead of initialising CUDA,
+# so checking for a GPU in the master does not break CUDA in the workers
+os.environ.setdefault("PYTORCH_NVML_BASED_CUDA_CHECK", "1")
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+# Grading waits on the LLM, so allow for slow upstream responses
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+
+# Load API.py (and, on CPU, the BERTScore weights) once in the master before
+# forking, so workers share the read-only weights copy-on-write instead of
+# each holding its own copy
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+
+def when_ready(server):
+    # The app is already imported with preload_app; load the weights before workers fork.
+    # CUDA cannot be initialised before fork, so on a GPU each worker loads its own in post_fork.
+    if preload_app and os.getenv("BERT_WARMUP", "1") == "1":
+        import torch
+        if torch.cuda.is_available():
+            return
+        import API
+        API.get_bert_batcher()
+
+
+def post_fork(server, worker):
+    # Workers already cover every core; more torch threads per worker only oversubscribe
+    import torch
+    torch.set_num_threads(int(os.getenv("TORCH_NUM_THREADS", 1)))
+
+    import API
+    API.start_bert_warmup()